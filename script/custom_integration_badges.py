@@ -1,34 +1,103 @@
 import aiohttp
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from functools import lru_cache
 import json
 import os
+import re
 from typing import Any
 
 DATA_URL = "https://analytics.home-assistant.io/custom_integrations.json"
 PROCESSED_PATH = "docs/badges/"
 RAW_PATH = "docs/raw/custom_integrations/"
+RAW_FILE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}\.json")
+ETAG_PATH = "docs/raw/custom_integrations.etag"
+TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+WRITE_WORKERS = 16
+
+
+def get_latest_raw_path() -> str | None:
+    """Get path of the latest saved raw data"""
+
+    # Only the daily files, so that the latest is found by name
+    try:
+        with os.scandir(RAW_PATH) as entries:
+            latest = max(
+                (
+                    entry.name
+                    for entry in entries
+                    if RAW_FILE_PATTERN.fullmatch(entry.name)
+                ),
+                default=None,
+            )
+    except FileNotFoundError:
+        return None
+
+    return RAW_PATH + latest if latest is not None else None
+
+
+def read_file(path: str) -> bytes | None:
+    """Read file if it exists"""
+
+    # Whole files are read at once, so no buffer is needed
+    try:
+        with open(path, "rb", buffering=0) as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def create_session() -> aiohttp.ClientSession:
+    """Create session"""
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=16,
+            limit_per_host=4,
+            ttl_dns_cache=300,
+        ),
+        timeout=TIMEOUT,
+    )
 
 
 async def async_get_data(session: aiohttp.ClientSession | None = None):
     """Load data"""
 
-    _session = session if session is not None else aiohttp.ClientSession()
+    # The session is owned by the caller when passed in
+    if session is None:
+        async with create_session() as _session:
+            return await async_get_data(_session)
+
+    # Only ask for changes when there is a local copy to fall back to
+    headers = {}
+    latest = get_latest_raw_path()
+    etag = read_file(ETAG_PATH) if latest is not None else None
+    if etag:
+        headers["If-None-Match"] = etag.decode()
 
-    async with _session.get(
+    async with session.get(
         url=DATA_URL,
+        headers=headers,
     ) as r:
-        json_body = await r.json()
-
-    await _session.close()
-
-    # Save the raw data
-    if not os.path.exists(RAW_PATH):
-        os.makedirs(RAW_PATH)
+        if r.status == 304:
+            # Not modified, reuse the latest saved data
+            raw = read_file(latest)
+        else:
+            r.raise_for_status()
+            raw = await r.read()
+            etag = r.headers.get("ETag", "").encode()
+
+    # Parse before saving, so that a broken response is never stored
+    json_body = json.loads(raw)
+
+    # Save the raw data as received
+    os.makedirs(RAW_PATH, exist_ok=True)
     today = date.today()
     path = RAW_PATH + today.isoformat() + ".json"
-    with open(path, "w") as file:
-        json.dump(json_body, file)
+    write_file(path, raw)
+    if etag:
+        write_file(ETAG_PATH, etag)
 
     return json_body
 
@@ -43,28 +112,62 @@ def generate_badge(installations: int) -> dict[str, Any]:
     }
 
 
+@lru_cache(maxsize=None)
+def generate_badge_content(installations: int) -> bytes:
+    """Generate serialized badge"""
+
+    # Many badges share the same count, so each one is encoded only once
+    return json.dumps(generate_badge(installations)).encode()
+
+
+def write_file(path: str, content: bytes) -> bool:
+    """Write file only if its content changes"""
+
+    if read_file(path) == content:
+        return False
+
+    # Replace atomically, so that an interrupted run never leaves a torn file
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+    return True
+
+
 async def async_test():
-    data = await async_get_data()
+    async with create_session() as session:
+        data = await async_get_data(session)
 
-    for integration in data:
+    # List the existing directories once instead of checking each of them
+    os.makedirs(PROCESSED_PATH, exist_ok=True)
+    existing = set(os.listdir(PROCESSED_PATH))
+
+    badges: dict[str, bytes] = {}
+    for integration, integration_data in data.items():
         path = PROCESSED_PATH + integration
         # Check the path
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if integration not in existing:
+            os.makedirs(path, exist_ok=True)
 
         # Generate total badge
-        if "total" in data[integration]:
-            badge = generate_badge(data[integration]["total"])
-            with open(f"{path}/total.json", "w") as file:
-                json.dump(badge, file)
+        if "total" in integration_data:
+            badges[path + "/total.json"] = generate_badge_content(
+                integration_data["total"]
+            )
         # Generate per-version badges
-        if "versions" in data[integration]:
-            for version in data[integration]["versions"]:
-                badge = generate_badge(data[integration]["versions"][version])
-                with open(f"{path}/version-{version}.json", "w") as file:
-                    json.dump(badge, file)
+        if "versions" in integration_data:
+            version_prefix = path + "/version-"
+            for version, installations in integration_data["versions"].items():
+                badges[version_prefix + version + ".json"] = generate_badge_content(
+                    installations
+                )
+
+    # Write all the badges at once, overlapping the file operations
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        updated = sum(executor.map(write_file, badges.keys(), badges.values()))
+
+    print(f"Updated {updated} of {len(badges)} badge files")
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(async_test())
-loop.close()
+asyncio.run(async_test())